@@ -1,18 +1,28 @@
 from __future__ import annotations
 
-import base64
 import hmac
 import hashlib
 import time
 from dataclasses import dataclass
+from functools import lru_cache
 
 from fastapi import HTTPException
 
-from app.config import settings
+try:
+    # Optional SIMD-accelerated drop-in for the stdlib codec.
+    import pybase64 as base64
+except ImportError:
+    import base64
+
+from app.config import RUNTIME, settings
 
 
 COOKIE_NAME = "nhm_session"
 
+# Pre-encoded so every comparison below can go through hmac.compare_digest.
+_EXPECTED_USER = (RUNTIME.auth_username or "").encode("utf-8")
+_EXPECTED_PW = (settings.auth_password or "").encode("utf-8")
+
 
 @dataclass(frozen=True)
 class Session:
@@ -24,21 +34,30 @@ def _b64url_encode(data: bytes) -> str:
     return base64.urlsafe_b64encode(data).decode("ascii").rstrip("=")
 
 
+_B64_PAD = (b"", b"===", b"==", b"=")
+
+
 def _b64url_decode(data: str) -> bytes:
-    pad = "=" * (-len(data) % 4)
-    return base64.urlsafe_b64decode((data + pad).encode("ascii"))
+    return base64.urlsafe_b64decode(data.encode("ascii") + _B64_PAD[len(data) & 3])
+
+
+@lru_cache(maxsize=1)
+def _mac_prototype(secret: bytes) -> hashlib.blake2b:
+    # Keyed state is set up once per secret; `_sign` only copies it.
+    key = hashlib.sha256(secret).digest()
+    return hashlib.blake2b(key=key, digest_size=16)
 
 
 def _sign(payload: bytes) -> str:
-    secret = (settings.auth_secret_key or "").encode("utf-8")
-    if not secret:
-        raise RuntimeError("AUTH_SECRET_KEY must be set when AUTH_ENABLED=true")
-    sig = hmac.new(secret, payload, hashlib.sha256).digest()
-    return _b64url_encode(sig)
+    # Keyed BLAKE2b is a MAC on its own: one pass, no HMAC inner/outer hashing.
+    # AUTH_SECRET_KEY is validated at startup (see Settings.__post_init__).
+    h = _mac_prototype(RUNTIME.auth_secret_key).copy()
+    h.update(payload)
+    return _b64url_encode(h.digest())
 
 
 def issue_session_cookie(username: str) -> str:
-    exp = int(time.time()) + int(settings.auth_session_minutes or 1440) * 60
+    exp = int(time.time()) + RUNTIME.auth_session_seconds
     payload = f"{username}|{exp}".encode("utf-8")
     token = f"{_b64url_encode(payload)}.{_sign(payload)}"
     return token
@@ -48,17 +67,20 @@ def verify_session_cookie(token: str | None) -> Session | None:
     if not token:
         return None
     try:
-        payload_b64, sig = token.split(".", 1)
-        payload = _b64url_decode(payload_b64)
-        expected = _sign(payload)
-        if not hmac.compare_digest(sig, expected):
+        dot = token.rfind(".")
+        if dot < 0:
+            return None
+        payload = _b64url_decode(token[:dot])
+        if not hmac.compare_digest(token[dot + 1 :], _sign(payload)):
             return None
-        raw = payload.decode("utf-8", errors="replace")
-        username, exp_s = raw.split("|", 1)
-        exp = int(exp_s)
+        # Parse `username|exp` on bytes; only the username is decoded to str.
+        bar = payload.rfind(b"|")
+        if bar < 0:
+            return None
+        exp = int(payload[bar + 1 :])
         if exp <= int(time.time()):
             return None
-        return Session(username=username, exp=exp)
+        return Session(username=payload[:bar].decode("utf-8", errors="replace"), exp=exp)
     except Exception:
         return None
 
@@ -66,16 +88,13 @@ def verify_session_cookie(token: str | None) -> Session | None:
 def require_login(session: Session | None) -> Session:
     if not session:
         raise HTTPException(status_code=401, detail="Not logged in")
-    if session.username != settings.auth_username:
+    if not hmac.compare_digest(session.username.encode("utf-8"), _EXPECTED_USER):
         raise HTTPException(status_code=403, detail="Forbidden")
     return session
 
 
 def verify_credentials(username: str, password: str) -> bool:
-    if username != settings.auth_username:
-        return False
-    expected = settings.auth_password or ""
-    if not expected:
-        raise RuntimeError("AUTH_PASSWORD must be set when AUTH_ENABLED=true")
-    return hmac.compare_digest(password, expected)
-
+    # Compare both fields unconditionally so timing does not reveal which one was wrong.
+    user_ok = hmac.compare_digest(username.encode("utf-8"), _EXPECTED_USER)
+    pw_ok = hmac.compare_digest(password.encode("utf-8"), _EXPECTED_PW)
+    return user_ok & pw_ok
@@ -1,45 +1,134 @@
-from pydantic import Field
-from pydantic_settings import BaseSettings, SettingsConfigDict
+import os
+from dataclasses import dataclass, fields
+from types import SimpleNamespace
 
 
-class Settings(BaseSettings):
-    model_config = SettingsConfigDict(env_file=".env", case_sensitive=False)
+_TRUE_VALUES = {"1", "true", "t", "yes", "y", "on"}
+_FALSE_VALUES = {"0", "false", "f", "no", "n", "off"}
 
-    app_name: str = Field("Nai Health Monitor", env="APP_NAME")
-    host: str = Field("0.0.0.0", env="HOST")
-    port: int = Field(5010, env="PORT")
 
-    ready_strategy: str = Field("all", env="READY_STRATEGY")  # all | any
+def _parse_bool(value: str) -> bool:
+    v = value.strip().lower()
+    if v in _TRUE_VALUES:
+        return True
+    if v in _FALSE_VALUES:
+        return False
+    raise ValueError(f"invalid boolean: {value!r}")
 
-    probe_interval_seconds: int = Field(30, env="PROBE_INTERVAL_SECONDS")
-    probe_timeout_seconds: float = Field(5.0, env="PROBE_TIMEOUT_SECONDS")
-    probe_concurrency: int = Field(20, env="PROBE_CONCURRENCY")
 
-    history_retention_minutes: int = Field(24 * 60, env="HISTORY_RETENTION_MINUTES")
-    history_max_points_per_target: int = Field(3000, env="HISTORY_MAX_POINTS_PER_TARGET")
-    availability_windows_minutes: str = Field("60,1440", env="AVAILABILITY_WINDOWS_MINUTES")
-    history_db_path: str = Field("./data/history.db", env="HISTORY_DB_PATH")
-    db_path: str = Field("", env="DB_PATH")
+_CONVERTERS = {str: str, int: int, float: float, bool: _parse_bool}
 
-    expose_urls: bool = Field(False, env="EXPOSE_URLS")
-    status_token: str = Field("", env="STATUS_TOKEN")
 
-    auth_enabled: bool = Field(True, env="AUTH_ENABLED")
-    auth_username: str = Field("admin", env="AUTH_USERNAME")
-    auth_password: str = Field("", env="AUTH_PASSWORD")
-    auth_secret_key: str = Field("", env="AUTH_SECRET_KEY")
-    auth_cookie_secure: bool = Field(False, env="AUTH_COOKIE_SECURE")
-    auth_session_minutes: int = Field(24 * 60, env="AUTH_SESSION_MINUTES")
+def _read_env_file(path: str) -> dict[str, str]:
+    """Minimal `.env` reader: KEY=VALUE lines, `#` comments, optional quotes."""
+    try:
+        with open(path, encoding="utf-8") as fh:
+            lines = fh.read().splitlines()
+    except FileNotFoundError:
+        return {}
+    out: dict[str, str] = {}
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if line.startswith("export "):
+            line = line[len("export ") :]
+        key, sep, value = line.partition("=")
+        if not sep:
+            continue
+        value = value.strip()
+        if len(value) >= 2 and value[0] == value[-1] and value[0] in ("'", '"'):
+            value = value[1:-1]
+        else:
+            value = value.split(" #", 1)[0].rstrip()
+        out[key.strip().upper()] = value
+    return out
 
-    keypool_enabled: bool = Field(False, env="KEYPOOL_ENABLED")
-    keypool_encryption_key: str = Field("", env="KEYPOOL_ENCRYPTION_KEY")
-    keypool_require_opus_tier: bool = Field(False, env="KEYPOOL_REQUIRE_OPUS_TIER")
-    keypool_health_check_enabled: bool = Field(True, env="KEYPOOL_HEALTH_CHECK_ENABLED")
-    keypool_health_check_interval_seconds: int = Field(300, env="KEYPOOL_HEALTH_CHECK_INTERVAL_SECONDS")
-    keypool_health_check_fail_threshold: int = Field(3, env="KEYPOOL_HEALTH_CHECK_FAIL_THRESHOLD")
+
+@dataclass(frozen=True, slots=True)
+class Settings:
+    app_name: str = "Nai Health Monitor"
+    host: str = "0.0.0.0"
+    port: int = 5010
+
+    ready_strategy: str = "all"  # all | any
+
+    probe_interval_seconds: int = 30
+    probe_timeout_seconds: float = 5.0
+    probe_concurrency: int = 20
+    probe_concurrency_per_host: int = 4
+    # Max response bytes read for contains/regex checks (0 = no limit). A check
+    # that fails after reaching it reports `body_limit_reached`.
+    probe_max_body_bytes: int = 0
+
+    history_retention_minutes: int = 24 * 60
+    history_max_points_per_target: int = 3000
+    availability_windows_minutes: str = "60,1440"
+    history_db_path: str = "./data/history.db"
+    db_path: str = ""
+
+    expose_urls: bool = False
+    status_token: str = ""
+
+    auth_enabled: bool = True
+    auth_username: str = "admin"
+    auth_password: str = ""
+    auth_secret_key: str = ""
+    auth_cookie_secure: bool = False
+    auth_session_minutes: int = 24 * 60
+
+    keypool_enabled: bool = False
+    keypool_encryption_key: str = ""
+    keypool_require_opus_tier: bool = False
+    keypool_health_check_enabled: bool = True
+    keypool_health_check_interval_seconds: int = 300
+    keypool_health_check_fail_threshold: int = 3
 
     # Legacy URL probing targets (unused when monitoring keys only).
-    targets: str = Field("", env="TARGETS")
+    targets: str = ""
+
+    def __post_init__(self) -> None:
+        # Fail at startup rather than on the first login / cookie check.
+        if self.auth_enabled:
+            if not self.auth_secret_key:
+                raise ValueError("AUTH_SECRET_KEY must be set when AUTH_ENABLED=true")
+            if not self.auth_password:
+                raise ValueError("AUTH_PASSWORD must be set when AUTH_ENABLED=true")
+
+    @classmethod
+    def load(cls, env_file: str = ".env") -> "Settings":
+        # Each field maps to its upper-cased name; process env wins over `.env`.
+        env = _read_env_file(env_file)
+        env.update((k.upper(), v) for k, v in os.environ.items())
+        values = {}
+        for f in fields(cls):
+            raw = env.get(f.name.upper())
+            if raw is None:
+                continue
+            try:
+                values[f.name] = _CONVERTERS[f.type](raw if f.type is str else raw.strip())
+            except ValueError as exc:
+                raise ValueError(f"{f.name.upper()}: {exc}") from exc
+        return cls(**values)
+
+
+settings = Settings.load()
+
+
+def _resolve_db_path(s: Settings) -> str:
+    preferred = (s.db_path or "").strip()
+    if preferred:
+        return preferred
+    path = (s.history_db_path or "./data/history.db").strip()
+    return path or "./data/history.db"
 
 
-settings = Settings()
+# Derived values read on every request / query, computed once so hot paths
+# skip the conversions and `or default` fallbacks.
+RUNTIME = SimpleNamespace(
+    auth_secret_key=(settings.auth_secret_key or "").encode("utf-8"),
+    auth_username=settings.auth_username,
+    auth_session_seconds=int(settings.auth_session_minutes or 1440) * 60,
+    db_path=_resolve_db_path(settings),
+    retention_seconds=int(settings.history_retention_minutes or 0) * 60,
+)
@@ -1,13 +1,16 @@
 from __future__ import annotations
 
+import asyncio
 import os
 import time
+from contextlib import asynccontextmanager
 from dataclasses import dataclass
 from pathlib import Path
+from typing import AsyncIterator
 
 import aiosqlite
 
-from app.config import settings
+from app.config import RUNTIME, settings
 
 
 SCHEMA_SQL = """
@@ -24,6 +27,8 @@ CREATE TABLE IF NOT EXISTS probe_events (
 );
 
 CREATE INDEX IF NOT EXISTS idx_probe_events_name_ts ON probe_events(name, ts);
+-- Lets monitor_timeline aggregate per cycle straight off the index, newest first.
+CREATE INDEX IF NOT EXISTS idx_probe_events_ts_ok ON probe_events(ts, ok);
 
 CREATE TABLE IF NOT EXISTS nai_keys (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -41,8 +46,13 @@ CREATE TABLE IF NOT EXISTS nai_keys (
   created_at REAL NOT NULL
 );
 
-CREATE INDEX IF NOT EXISTS idx_nai_keys_status_enabled ON nai_keys(status, is_enabled);
+DROP INDEX IF EXISTS idx_nai_keys_status_enabled;
 CREATE INDEX IF NOT EXISTS idx_nai_keys_cooldown ON nai_keys(cooldown_until);
+CREATE INDEX IF NOT EXISTS idx_nai_keys_checkout
+  ON nai_keys(is_enabled, status, cooldown_until, last_checked_out_at) WHERE is_enabled=1;
+-- Matches checkout_best_key's ORDER BY exactly, so the pick is an index walk with no sort.
+CREATE INDEX IF NOT EXISTS idx_nai_keys_checkout_order
+  ON nai_keys(total_checkouts, COALESCE(last_checked_out_at, 0), id) WHERE is_enabled=1 AND status='healthy';
 
 CREATE TABLE IF NOT EXISTS system_config (
   key TEXT PRIMARY KEY,
@@ -62,40 +72,146 @@ CREATE TABLE IF NOT EXISTS key_health_events (
 CREATE INDEX IF NOT EXISTS idx_key_health_events_ts ON key_health_events(ts);
 """
 
+# Distinct target names via an index skip-scan (one seek per name, not per row).
+DISTINCT_NAMES_SQL = """
+WITH RECURSIVE names(name) AS (
+  SELECT MIN(name) FROM probe_events
+  UNION ALL
+  SELECT (SELECT MIN(name) FROM probe_events WHERE name > names.name) FROM names WHERE names.name IS NOT NULL
+)
+SELECT name FROM names WHERE name IS NOT NULL
+"""
+
+# Applied whenever a connection is opened (these are per-connection settings).
+CONNECTION_PRAGMAS_SQL = """
+PRAGMA journal_mode=WAL;
+PRAGMA synchronous=NORMAL;
+PRAGMA temp_store=MEMORY;
+PRAGMA mmap_size=268435456;
+PRAGMA cache_size=-65536;
+PRAGMA wal_autocheckpoint=1000;
+PRAGMA busy_timeout=5000;
+"""
+
+# Write statements kept as fixed module-level text so every call hits the
+# connection's prepared-statement cache instead of re-parsing SQL.
+INSERT_PROBE_EVENT_SQL = "INSERT INTO probe_events(name, ts, ok, status_code, latency_ms) VALUES (?, ?, ?, ?, ?)"
+INSERT_KEY_HEALTH_EVENT_SQL = (
+    "INSERT INTO key_health_events(ts, enabled, healthy, unhealthy, invalid, pending) VALUES (?, ?, ?, ?, ?, ?)"
+)
+UPSERT_CONFIG_SQL = """
+INSERT INTO system_config(key, value, updated_at)
+VALUES (?, ?, ?)
+ON CONFLICT(key) DO UPDATE SET value=excluded.value, updated_at=excluded.updated_at
+"""
+STATEMENT_CACHE_SIZE = 256
+
+_conn: aiosqlite.Connection | None = None
+_initialized = False
+_conn_lock = asyncio.Lock()
+# The connection runs in autocommit mode; explicit transactions are serialized
+# so statements from other coroutines never land inside someone else's BEGIN.
+_write_lock = asyncio.Lock()
+
+# Probe rows queued by `queue_events` and written in bulk by `events_writer_loop`:
+# one transaction per interval (spanning several probe cycles at short probe
+# intervals), or sooner once EVENTS_FLUSH_MAX_ROWS rows are pending.
+EVENTS_FLUSH_INTERVAL_SECONDS = 5.0
+EVENTS_FLUSH_MAX_ROWS = 500
+# Backpressure: rows beyond this are dropped while SQLite cannot keep up.
+EVENTS_MAX_PENDING = 50_000
+# The writer also prunes history, at most this often (and once at start).
+PRUNE_INTERVAL_SECONDS = 30 * 60
+_pending_events: list[tuple] = []
+_events_ready = asyncio.Event()
+_flush_lock = asyncio.Lock()
+
 
 def _db_path() -> str:
-    preferred = (settings.db_path or "").strip()
-    if preferred:
-        return preferred
-    path = (settings.history_db_path or "./data/history.db").strip()
-    return path or "./data/history.db"
+    return RUNTIME.db_path
+
+
+async def _get_conn() -> aiosqlite.Connection:
+    global _conn
+    if _conn is not None:
+        return _conn
+    async with _conn_lock:
+        if _conn is None:
+            path = _db_path()
+            Path(os.path.dirname(path) or ".").mkdir(parents=True, exist_ok=True)
+            db = await aiosqlite.connect(path, isolation_level=None, cached_statements=STATEMENT_CACHE_SIZE)
+            await db.executescript(CONNECTION_PRAGMAS_SQL)
+            _conn = db
+    return _conn
+
+
+@asynccontextmanager
+async def _transaction() -> AsyncIterator[aiosqlite.Connection]:
+    db = await _get_conn()
+    async with _write_lock:
+        # IMMEDIATE: every caller writes, so take the write lock up front rather
+        # than upgrading mid-transaction (which can fail with SQLITE_BUSY).
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            await db.rollback()
+            raise
+        await db.commit()
+
+
+@asynccontextmanager
+async def _autocommit() -> AsyncIterator[aiosqlite.Connection]:
+    # Single-statement writes: no BEGIN/COMMIT, but still serialized with
+    # `_transaction` so the statement cannot join another coroutine's BEGIN.
+    db = await _get_conn()
+    async with _write_lock:
+        yield db
+
+
+async def close_db() -> None:
+    global _conn
+    async with _conn_lock:
+        if _conn is not None:
+            # Refresh planner statistics so the partial indexes get picked on large tables.
+            await _conn.execute("PRAGMA optimize")
+            await _conn.close()
+            _conn = None
 
 
 async def init_db() -> None:
-    path = _db_path()
-    Path(os.path.dirname(path) or ".").mkdir(parents=True, exist_ok=True)
-    async with aiosqlite.connect(path) as db:
+    global _initialized
+    if _initialized:
+        return
+    db = await _get_conn()
+    async with _write_lock:
         await db.executescript(SCHEMA_SQL)
-        # Lightweight migrations for existing SQLite files.
-        async with db.execute("PRAGMA table_info('nai_keys')") as cur:
-            cols = await cur.fetchall()
-        col_names = {str(r[1]) for r in cols}
-        if "cooldown_until" not in col_names:
+    # Lightweight migrations for existing SQLite files.
+    async with db.execute("PRAGMA table_info('nai_keys')") as cur:
+        cols = await cur.fetchall()
+    col_names = {str(r[1]) for r in cols}
+    if "cooldown_until" not in col_names:
+        async with _transaction() as db:
             await db.execute("ALTER TABLE nai_keys ADD COLUMN cooldown_until REAL")
             await db.execute("CREATE INDEX IF NOT EXISTS idx_nai_keys_cooldown ON nai_keys(cooldown_until)")
-        await db.commit()
+    # Statistics for the key-checkout indexes from the first query on, not only
+    # after the first clean shutdown (close_db). nai_keys is small; the event
+    # tables are left to PRAGMA optimize.
+    async with _write_lock:
+        await db.execute("ANALYZE nai_keys")
+    _initialized = True
 
 
 async def get_config(keys: list[str]) -> dict[str, str]:
     if not keys:
         return {}
     placeholders = ",".join("?" for _ in keys)
-    async with aiosqlite.connect(_db_path()) as db:
-        async with db.execute(
-            f"SELECT key, value FROM system_config WHERE key IN ({placeholders})",
-            tuple(keys),
-        ) as cur:
-            rows = await cur.fetchall()
+    db = await _get_conn()
+    async with db.execute(
+        f"SELECT key, value FROM system_config WHERE key IN ({placeholders})",
+        tuple(keys),
+    ) as cur:
+        rows = await cur.fetchall()
     return {str(k): ("" if v is None else str(v)) for (k, v) in rows}
 
 
@@ -103,56 +219,47 @@ async def set_config(values: dict[str, str]) -> None:
     if not values:
         return
     now = time.time()
-    async with aiosqlite.connect(_db_path()) as db:
-        await db.execute("BEGIN")
-        for k, v in values.items():
-            await db.execute(
-                """
-                INSERT INTO system_config(key, value, updated_at)
-                VALUES (?, ?, ?)
-                ON CONFLICT(key) DO UPDATE SET value=excluded.value, updated_at=excluded.updated_at
-                """,
-                (str(k), str(v), now),
-            )
-        await db.commit()
+    async with _transaction() as db:
+        await db.executemany(UPSERT_CONFIG_SQL, [(str(k), str(v), now) for k, v in values.items()])
 
 
 async def insert_key_health_event(enabled: int, healthy: int, unhealthy: int, invalid: int, pending: int) -> None:
     now = time.time()
-    async with aiosqlite.connect(_db_path()) as db:
+    async with _autocommit() as db:
         await db.execute(
-            "INSERT INTO key_health_events(ts, enabled, healthy, unhealthy, invalid, pending) VALUES (?, ?, ?, ?, ?, ?)",
+            INSERT_KEY_HEALTH_EVENT_SQL,
             (now, int(enabled), int(healthy), int(unhealthy), int(invalid), int(pending)),
         )
-        await db.commit()
 
 
 async def key_health_timeline(limit: int = 240) -> list[dict]:
     limit = max(1, int(limit or 240))
-    async with aiosqlite.connect(_db_path()) as db:
-        async with db.execute(
-            """
-            SELECT ts, enabled, healthy, unhealthy, invalid, pending
-            FROM key_health_events
-            ORDER BY ts DESC
-            LIMIT ?
-            """,
-            (limit,),
-        ) as cur:
-            rows = await cur.fetchall()
-    out = [
+    db = await _get_conn()
+    async with db.execute(
+        """
+        SELECT ts, enabled, healthy, unhealthy, invalid, pending
+        FROM (
+          SELECT ts, enabled, healthy, unhealthy, invalid, pending
+          FROM key_health_events
+          ORDER BY ts DESC
+          LIMIT ?
+        )
+        ORDER BY ts ASC
+        """,
+        (limit,),
+    ) as cur:
+        rows = await cur.fetchall()
+    return [
         {
-            "ts": float(ts),
-            "enabled": int(enabled),
-            "healthy": int(healthy),
-            "unhealthy": int(unhealthy),
-            "invalid": int(invalid),
-            "pending": int(pending),
+            "ts": ts,
+            "enabled": enabled,
+            "healthy": healthy,
+            "unhealthy": unhealthy,
+            "invalid": invalid,
+            "pending": pending,
         }
         for (ts, enabled, healthy, unhealthy, invalid, pending) in rows
     ]
-    out.reverse()
-    return out
 
 
 @dataclass(frozen=True)
@@ -177,114 +284,157 @@ def parse_windows_minutes(raw: str) -> list[int]:
 async def insert_events(rows: list[tuple]) -> None:
     if not rows:
         return
-    async with aiosqlite.connect(_db_path()) as db:
-        await db.executemany(
-            "INSERT INTO probe_events(name, ts, ok, status_code, latency_ms) VALUES (?, ?, ?, ?, ?)",
-            rows,
-        )
-        await db.commit()
+    async with _transaction() as db:
+        await db.executemany(INSERT_PROBE_EVENT_SQL, rows)
+
+
+def queue_events(rows: list[tuple]) -> None:
+    """Buffer probe rows without touching SQLite; see `events_writer_loop`."""
+    room = EVENTS_MAX_PENDING - len(_pending_events)
+    if room <= 0:
+        return
+    _pending_events.extend(rows[:room])
+    if len(_pending_events) >= EVENTS_FLUSH_MAX_ROWS:
+        _events_ready.set()
+
+
+async def _flush_pending() -> None:
+    async with _flush_lock:
+        if not _pending_events:
+            return
+        # Rows leave the buffer only once written: a failed insert keeps them
+        # for the next flush, and rows queued meanwhile stay behind them.
+        rows = _pending_events[:]
+        await insert_events(rows)
+        del _pending_events[: len(rows)]
+
+
+async def flush_events() -> None:
+    # Shielded so cancelling the caller cannot separate the insert from the
+    # buffer update (rows committed but still queued, or dropped unwritten).
+    await asyncio.shield(_flush_pending())
 
 
 async def prune_old(retention_minutes: int) -> None:
     if retention_minutes <= 0:
         return
     cutoff = time.time() - (int(retention_minutes) * 60)
-    async with aiosqlite.connect(_db_path()) as db:
+    async with _autocommit() as db:
         await db.execute("DELETE FROM probe_events WHERE ts < ?", (cutoff,))
-        await db.commit()
 
 
 async def prune_max_points_per_target(max_points: int) -> None:
     if max_points <= 0:
         return
-    # Keep newest N per target (SQLite window functions; SQLite >= 3.25).
-    async with aiosqlite.connect(_db_path()) as db:
-        await db.execute(
+    # Keep newest N per target: one indexed range delete per name.
+    async with _transaction() as db:
+        async with db.execute(DISTINCT_NAMES_SQL) as cur:
+            names = [name for (name,) in await cur.fetchall()]
+        await db.executemany(
             """
             DELETE FROM probe_events
-            WHERE id IN (
-              SELECT id FROM (
-                SELECT id,
-                       ROW_NUMBER() OVER (PARTITION BY name ORDER BY ts DESC) AS rn
-                FROM probe_events
-              ) WHERE rn > ?
+            WHERE name = ? AND ts < (
+              SELECT MIN(ts) FROM (
+                SELECT ts FROM probe_events WHERE name = ? ORDER BY ts DESC LIMIT ?
+              )
             )
             """,
-            (int(max_points),),
+            [(name, name, int(max_points)) for name in names],
         )
-        await db.commit()
+
+
+async def prune_history() -> None:
+    await prune_old(int(settings.history_retention_minutes or 0))
+    await prune_max_points_per_target(int(settings.history_max_points_per_target or 0))
+
+
+async def events_writer_loop() -> None:
+    last_prune: float | None = None
+    while True:
+        try:
+            await asyncio.wait_for(_events_ready.wait(), EVENTS_FLUSH_INTERVAL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        _events_ready.clear()
+        try:
+            await flush_events()
+            now = time.monotonic()
+            if last_prune is None or now - last_prune >= PRUNE_INTERVAL_SECONDS:
+                last_prune = now
+                await prune_history()
+        except Exception:
+            pass
 
 
 async def availability_by_target(windows_minutes: list[int]) -> dict[str, Availability]:
     windows_minutes = windows_minutes or parse_windows_minutes(settings.availability_windows_minutes)
     now = time.time()
+    keys = [f"{int(m)}m" for m in windows_minutes]
+    cutoffs = [now - (int(m) * 60) for m in windows_minutes]
+
+    # since retention window (best-effort): based on current retention cutoff
+    retention_cutoff = now - RUNTIME.retention_seconds if RUNTIME.retention_seconds > 0 else None
+
+    # One pass over the scan range: each window is a conditional aggregate.
+    window_cols = ", ".join("SUM(CASE WHEN ts >= ? THEN ok END), SUM(CASE WHEN ts >= ? THEN 1 END)" for _ in cutoffs)
+    params: list[float] = []
+    for cutoff in cutoffs:
+        params.extend((cutoff, cutoff))
+    if retention_cutoff is not None:
+        retention_cols = "SUM(CASE WHEN ts >= ? THEN ok END), SUM(CASE WHEN ts >= ? THEN 1 END)"
+        params.extend((retention_cutoff, retention_cutoff))
+    else:
+        retention_cols = "NULL, NULL"
+    params.append(min(cutoffs if retention_cutoff is None else [*cutoffs, retention_cutoff]))
+
+    def _percent(ok_sum, total) -> float | None:
+        total = int(total or 0)
+        return round(int(ok_sum or 0) * 100.0 / total, 2) if total > 0 else None
+
     by_name: dict[str, Availability] = {}
+    db = await _get_conn()
+    async with db.execute(
+        f"SELECT name, {window_cols}, {retention_cols} FROM probe_events WHERE ts >= ? GROUP BY name",
+        tuple(params),
+    ) as cur:
+        async for row in cur:
+            windows = {
+                key: _percent(row[1 + 2 * i], row[2 + 2 * i]) for i, key in enumerate(keys) if row[2 + 2 * i]
+            }
+            since_retention = _percent(row[-2], row[-1]) if retention_cutoff is not None else None
+            by_name[row[0]] = Availability(windows_percent=windows, since_retention_percent=since_retention)
 
-    async with aiosqlite.connect(_db_path()) as db:
-        # since retention window (best-effort): based on current retention cutoff
-        retention_minutes = int(settings.history_retention_minutes or 0)
-        if retention_minutes > 0:
-            cutoff = now - (retention_minutes * 60)
-            async with db.execute(
-                "SELECT name, SUM(ok), COUNT(*) FROM probe_events WHERE ts >= ? GROUP BY name",
-                (cutoff,),
-            ) as cur:
-                async for name, ok_sum, total in cur:
-                    total = int(total or 0)
-                    ok_sum = int(ok_sum or 0)
-                    percent = round(ok_sum * 100.0 / total, 2) if total > 0 else None
-                    by_name[name] = Availability(windows_percent={}, since_retention_percent=percent)
-
-        for minutes in windows_minutes:
-            cutoff = now - (int(minutes) * 60)
-            key = f"{int(minutes)}m"
-            async with db.execute(
-                "SELECT name, SUM(ok), COUNT(*) FROM probe_events WHERE ts >= ? GROUP BY name",
-                (cutoff,),
-            ) as cur:
-                async for name, ok_sum, total in cur:
-                    total = int(total or 0)
-                    ok_sum = int(ok_sum or 0)
-                    percent = round(ok_sum * 100.0 / total, 2) if total > 0 else None
-                    current = by_name.get(name) or Availability(windows_percent={}, since_retention_percent=None)
-                    current.windows_percent[key] = percent
-                    by_name[name] = current
-
-    return {
-        name: Availability(
-            windows_percent=dict(v.windows_percent),
-            since_retention_percent=v.since_retention_percent,
-        )
-        for name, v in by_name.items()
-    }
+    return by_name
 
 
 async def history_tail_per_target(limit: int) -> dict[str, list[dict]]:
     limit = max(1, int(limit or 120))
     series: dict[str, list[dict]] = {}
-    async with aiosqlite.connect(_db_path()) as db:
+    db = await _get_conn()
+    # Walk idx_probe_events_name_ts once per target instead of ranking every row.
+    async with db.execute(DISTINCT_NAMES_SQL) as cur:
+        names = [name for (name,) in await cur.fetchall()]
+    for name in names:
         async with db.execute(
             """
-            SELECT name, ts, ok, status_code, latency_ms
+            SELECT ts, ok, status_code, latency_ms
             FROM (
-              SELECT name, ts, ok, status_code, latency_ms,
-                     ROW_NUMBER() OVER (PARTITION BY name ORDER BY ts DESC) AS rn
+              SELECT ts, ok, status_code, latency_ms
               FROM probe_events
+              WHERE name = ?
+              ORDER BY ts DESC
+              LIMIT ?
             )
-            WHERE rn <= ?
-            ORDER BY name ASC, ts ASC
+            ORDER BY ts ASC
             """,
-            (limit,),
+            (name, limit),
         ) as cur:
-            async for name, ts, ok, status_code, latency_ms in cur:
-                series.setdefault(name, []).append(
-                    {
-                        "ts": float(ts),
-                        "ok": bool(ok),
-                        "status_code": status_code if status_code is None else int(status_code),
-                        "latency_ms": latency_ms if latency_ms is None else float(latency_ms),
-                    }
-                )
+            rows = await cur.fetchall()
+        # Columns are typed (REAL/INTEGER), so values come back as float/int already.
+        series[name] = [
+            {"ts": ts, "ok": ok == 1, "status_code": status_code, "latency_ms": latency_ms}
+            for (ts, ok, status_code, latency_ms) in rows
+        ]
     return series
 
 
@@ -294,21 +444,21 @@ async def monitor_timeline(limit: int = 240) -> list[dict]:
     Each cycle inserts one row per target with the same `ts`.
     """
     limit = max(1, int(limit or 240))
-    async with aiosqlite.connect(_db_path()) as db:
-        async with db.execute(
-            """
-            SELECT ts, SUM(ok) AS ok_count, COUNT(*) AS total_count
-            FROM probe_events
-            GROUP BY ts
-            ORDER BY ts DESC
-            LIMIT ?
-            """,
-            (limit,),
-        ) as cur:
-            rows = await cur.fetchall()
-    out = [
-        {"ts": float(ts), "ok": int(ok_count or 0), "total": int(total_count or 0)}
-        for (ts, ok_count, total_count) in rows
-    ]
-    out.reverse()
-    return out
+    db = await _get_conn()
+    async with db.execute(
+        """
+        SELECT ts, ok_count, total_count
+        FROM (
+          SELECT ts, SUM(ok) AS ok_count, COUNT(*) AS total_count
+          FROM probe_events
+          GROUP BY ts
+          ORDER BY ts DESC
+          LIMIT ?
+        )
+        ORDER BY ts ASC
+        """,
+        (limit,),
+    ) as cur:
+        rows = await cur.fetchall()
+    # Each group has at least one row, so the aggregates are never NULL.
+    return [{"ts": ts, "ok": ok_count, "total": total_count} for (ts, ok_count, total_count) in rows]
@@ -1,8 +1,11 @@
 from __future__ import annotations
 
+import asyncio
 import hashlib
+import json
 import time
 from dataclasses import dataclass
+from functools import lru_cache
 from typing import Mapping
 
 import aiosqlite
@@ -10,10 +13,94 @@ import httpx
 from cryptography.fernet import Fernet
 
 from app.config import settings
-from app.history_db import _db_path, get_config, insert_key_health_event
+from app.history_db import _autocommit, _get_conn, _transaction, get_config, insert_key_health_event
 
 
 SUBSCRIPTION_URL = "https://api.novelai.net/user/subscription"
+# Upper bound on concurrent subscription checks during a full sweep.
+CHECK_CONCURRENCY = 16
+# Keys checked per write transaction during a full sweep.
+CHECK_BATCH_SIZE = 50
+
+
+# Statement text is kept stable (module constants) so the connection's
+# statement cache parses each query once instead of on every call.
+INSERT_KEY_SQL = """
+INSERT OR IGNORE INTO nai_keys(key_hash, key_encrypted, status, is_enabled, fail_streak, created_at)
+VALUES (?, ?, 'pending', 1, 0, ?)
+"""
+_KEY_COLUMNS = (
+    "id",
+    "key_hash",
+    "status",
+    "tier",
+    "is_enabled",
+    "fail_streak",
+    "cooldown_until",
+    "last_checked_at",
+    "last_error",
+    "total_checkouts",
+    "last_checked_out_at",
+    "created_at",
+)
+LIST_KEYS_SQL = f"SELECT {', '.join(_KEY_COLUMNS)} FROM nai_keys ORDER BY id DESC"
+SET_ENABLED_SQL = "UPDATE nai_keys SET is_enabled=? WHERE id=?"
+DELETE_KEY_SQL = "DELETE FROM nai_keys WHERE id=?"
+# Conditional: a longer cooldown written since the check's SELECT is kept.
+SET_COOLDOWN_SQL = (
+    "UPDATE nai_keys SET cooldown_until=? WHERE id=? AND (cooldown_until IS NULL OR cooldown_until < ?)"
+)
+MARK_STATUS_SQL = """
+UPDATE nai_keys
+SET status=?, tier=?, last_checked_at=?, last_error=?, fail_streak=?
+WHERE id=?
+"""
+SELECT_KEY_FOR_CHECK_SQL = "SELECT id, key_encrypted, status, tier, fail_streak, cooldown_until FROM nai_keys WHERE id=?"
+ENABLED_KEY_IDS_SQL = "SELECT id FROM nai_keys WHERE is_enabled=1"
+# Pick and bump in one statement (SQLite >= 3.35): atomic without BEGIN IMMEDIATE.
+CHECKOUT_KEY_SQL = """
+UPDATE nai_keys
+SET total_checkouts = total_checkouts + 1, last_checked_out_at = ?
+WHERE id = (
+  SELECT id FROM nai_keys
+  WHERE is_enabled=1 AND status='healthy' AND (cooldown_until IS NULL OR cooldown_until <= ?)
+  ORDER BY total_checkouts ASC, COALESCE(last_checked_out_at, 0) ASC, id ASC
+  LIMIT 1
+)
+RETURNING id, key_encrypted, key_hash
+"""
+# One scan: per-status totals plus the enabled-only aggregates.
+SUMMARY_SQL = """
+SELECT status,
+       COUNT(*),
+       SUM(is_enabled=1),
+       MAX(CASE WHEN is_enabled=1 THEN last_checked_at END)
+FROM nai_keys
+GROUP BY status
+"""
+
+
+_http: httpx.AsyncClient | None = None
+
+
+def _get_http() -> httpx.AsyncClient:
+    # One pooled client for all checks: keep-alive (and HTTP/2 multiplexing)
+    # to api.novelai.net instead of a fresh DNS + TCP + TLS setup per key.
+    global _http
+    if _http is None:
+        _http = httpx.AsyncClient(
+            timeout=15.0,
+            limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+            http2=True,
+        )
+    return _http
+
+
+async def close_http() -> None:
+    global _http
+    if _http is not None:
+        await _http.aclose()
+        _http = None
 
 
 def _require_keypool_enabled() -> None:
@@ -21,7 +108,9 @@ def _require_keypool_enabled() -> None:
         raise RuntimeError("KEYPOOL_ENABLED=false")
 
 
+@lru_cache(maxsize=1)
 def _fernet() -> Fernet:
+    # Built once: Fernet parses the key and sets up its signing/encryption keys up front.
     key = (settings.keypool_encryption_key or "").strip().encode("utf-8")
     if not key:
         raise RuntimeError("KEYPOOL_ENCRYPTION_KEY must be set when KEYPOOL_ENABLED=true")
@@ -49,20 +138,17 @@ def decrypt_key(encrypted: str) -> str:
     return _fernet().decrypt(encrypted.encode("utf-8")).decode("utf-8")
 
 
-@dataclass(frozen=True)
-class KeyRow:
-    id: int
-    key_hash: str
-    status: str
-    tier: int | None
-    is_enabled: bool
-    fail_streak: int
-    cooldown_until: float | None
-    last_checked_at: float | None
-    last_error: str | None
-    total_checkouts: int
-    last_checked_out_at: float | None
-    created_at: float
+def _import_rows(keys: list[str], now: float) -> list[tuple[str, str, float]]:
+    # Same values as hash_key/encrypt_key, with the per-key attribute lookups
+    # hoisted out of the loop; this is pure Python overhead for short keys.
+    sha256 = hashlib.sha256
+    encrypt = _fernet().encrypt
+    rows = []
+    append = rows.append
+    for k in keys:
+        b = k.encode("utf-8")
+        append((sha256(b).hexdigest(), encrypt(b).decode("utf-8"), now))
+    return rows
 
 
 async def import_keys(raw: str) -> dict:
@@ -71,72 +157,38 @@ async def import_keys(raw: str) -> dict:
     if not keys:
         return {"received": 0, "created": 0, "skipped_existing": 0}
 
-    now = time.time()
-    created = 0
-    skipped = 0
-    async with aiosqlite.connect(_db_path()) as db:
-        await db.execute("BEGIN")
-        for k in keys:
-            h = hash_key(k)
-            enc = encrypt_key(k)
-            try:
-                await db.execute(
-                    """
-                    INSERT INTO nai_keys(key_hash, key_encrypted, status, is_enabled, fail_streak, created_at)
-                    VALUES (?, ?, 'pending', 1, 0, ?)
-                    """,
-                    (h, enc, now),
-                )
-                created += 1
-            except aiosqlite.IntegrityError:
-                skipped += 1
-        await db.commit()
-    return {"received": len(keys), "created": created, "skipped_existing": skipped}
-
-
-async def list_keys() -> list[KeyRow]:
+    # Hash + encrypt the whole batch off the event loop.
+    rows = await asyncio.to_thread(_import_rows, keys, time.time())
+    async with _transaction() as db:
+        before = db.total_changes
+        # OR IGNORE: keys already in the pool (UNIQUE key_hash) are skipped, not fatal.
+        await db.executemany(INSERT_KEY_SQL, rows)
+        created = db.total_changes - before
+    return {"received": len(keys), "created": created, "skipped_existing": len(keys) - created}
+
+
+async def list_keys() -> list[dict]:
     _require_keypool_enabled()
-    async with aiosqlite.connect(_db_path()) as db:
-        async with db.execute(
-            """
-            SELECT id, key_hash, status, tier, is_enabled, fail_streak, cooldown_until, last_checked_at, last_error,
-                   total_checkouts, last_checked_out_at, created_at
-            FROM nai_keys
-            ORDER BY id DESC
-            """
-        ) as cur:
-            rows = await cur.fetchall()
-    return [
-        KeyRow(
-            id=int(r[0]),
-            key_hash=str(r[1]),
-            status=str(r[2]),
-            tier=(None if r[3] is None else int(r[3])),
-            is_enabled=bool(r[4]),
-            fail_streak=int(r[5] or 0),
-            cooldown_until=(None if r[6] is None else float(r[6])),
-            last_checked_at=(None if r[7] is None else float(r[7])),
-            last_error=(None if r[8] is None else str(r[8])),
-            total_checkouts=int(r[9] or 0),
-            last_checked_out_at=(None if r[10] is None else float(r[10])),
-            created_at=float(r[11]),
-        )
-        for r in rows
-    ]
+    db = await _get_conn()
+    async with db.execute(LIST_KEYS_SQL) as cur:
+        rows = await cur.fetchall()
+    # Column affinities already give int/float/None; only the flag needs converting.
+    items = [dict(zip(_KEY_COLUMNS, r)) for r in rows]
+    for item in items:
+        item["is_enabled"] = bool(item["is_enabled"])
+    return items
 
 
 async def set_enabled(key_id: int, enabled: bool) -> None:
     _require_keypool_enabled()
-    async with aiosqlite.connect(_db_path()) as db:
-        await db.execute("UPDATE nai_keys SET is_enabled=? WHERE id=?", (1 if enabled else 0, int(key_id)))
-        await db.commit()
+    async with _autocommit() as db:
+        await db.execute(SET_ENABLED_SQL, (1 if enabled else 0, int(key_id)))
 
 
 async def delete_key(key_id: int) -> None:
     _require_keypool_enabled()
-    async with aiosqlite.connect(_db_path()) as db:
-        await db.execute("DELETE FROM nai_keys WHERE id=?", (int(key_id),))
-        await db.commit()
+    async with _autocommit() as db:
+        await db.execute(DELETE_KEY_SQL, (int(key_id),))
 
 
 def _parse_retry_after(headers: Mapping[str, str] | None) -> int | None:
@@ -153,6 +205,48 @@ def _parse_retry_after(headers: Mapping[str, str] | None) -> int | None:
         return None
 
 
+@dataclass(frozen=True)
+class _StatusPolicy:
+    """How a non-2xx subscription response updates a key."""
+
+    result: str
+    # Fixed new status; None keeps the current one (or degrades it, see `degrade`).
+    status: str | None = None
+    # Mark "unhealthy" once fail_streak reaches the threshold.
+    degrade: bool = False
+    keep_tier: bool = True
+    # Stored as last_error; None means "HTTP <code>".
+    error: str | None = None
+    backoff_base: int = 0
+    backoff_max: int = 0
+    # Transient errors never push fail_streak past the threshold.
+    cap_streak: bool = False
+    honor_retry_after: bool = False
+
+
+# Follow your NovelAI error-code mapping.
+_POLICIES: dict[int, _StatusPolicy] = {
+    401: _StatusPolicy("invalid", status="invalid", keep_tier=False, error="Unauthorized"),
+    403: _StatusPolicy("invalid", status="invalid", error="Forbidden"),
+    # Quota/subscription issue: treat as unhealthy and back off longer.
+    402: _StatusPolicy("unhealthy", degrade=True, error="Payment Required (402)", backoff_base=60, backoff_max=3600),
+    # Concurrency / rate limit: transient, do not immediately mark invalid.
+    409: _StatusPolicy("transient", backoff_base=3, backoff_max=300, cap_streak=True),
+    429: _StatusPolicy("transient", backoff_base=8, backoff_max=300, cap_streak=True, honor_retry_after=True),
+}
+# Upstream/server issue: transient. Mark unhealthy only after threshold.
+_SERVER_ERROR_POLICY = _StatusPolicy("transient", degrade=True, backoff_base=15, backoff_max=600)
+# Other 4xx: treat as unknown, degrade after threshold.
+_CLIENT_ERROR_POLICY = _StatusPolicy("unhealthy", degrade=True)
+
+
+def _classify(code: int) -> _StatusPolicy:
+    policy = _POLICIES.get(code)
+    if policy is not None:
+        return policy
+    return _SERVER_ERROR_POLICY if code >= 500 else _CLIENT_ERROR_POLICY
+
+
 def _compute_backoff(base_seconds: int, fail_streak: int, max_seconds: int = 600) -> int:
     if base_seconds <= 0:
         return 0
@@ -162,14 +256,19 @@ def _compute_backoff(base_seconds: int, fail_streak: int, max_seconds: int = 600
     return min(seconds, max_seconds) if max_seconds > 0 else seconds
 
 
-async def _set_cooldown(db: aiosqlite.Connection, key_id: int, seconds: int) -> None:
+def _extend_cooldown(current: float | None, seconds: int) -> float | None:
+    # Not shorter than the cooldown read at check time (the row may have moved
+    # on since; SET_COOLDOWN_SQL re-checks). None means "leave it unchanged".
     if seconds <= 0:
-        return
+        return None
     until = time.time() + int(seconds)
-    await db.execute(
-        "UPDATE nai_keys SET cooldown_until = COALESCE(MAX(cooldown_until, ?), ?) WHERE id=?",
-        (until, until, int(key_id)),
-    )
+    return until if current is None else max(float(current), until)
+
+
+async def _set_cooldown(db: aiosqlite.Connection, key_id: int, until: float | None) -> None:
+    if until is None:
+        return
+    await db.execute(SET_COOLDOWN_SQL, (until, int(key_id), until))
 
 
 async def _mark_status(
@@ -180,145 +279,185 @@ async def _mark_status(
     error: str | None,
     fail_streak: int,
 ) -> None:
-    await db.execute(
-        """
-        UPDATE nai_keys
-        SET status=?, tier=?, last_checked_at=?, last_error=?, fail_streak=?
-        WHERE id=?
-        """,
-        (status, tier, time.time(), error, int(fail_streak), int(key_id)),
-    )
+    await db.execute(MARK_STATUS_SQL, (status, tier, time.time(), error, int(fail_streak), int(key_id)))
 
 
-async def check_key_health(key_id: int) -> dict:
-    _require_keypool_enabled()
-    async with aiosqlite.connect(_db_path()) as db:
-        async with db.execute(
-            "SELECT id, key_encrypted, status, tier, fail_streak FROM nai_keys WHERE id=?",
-            (int(key_id),),
-        ) as cur:
-            row = await cur.fetchone()
-        if not row:
-            raise KeyError("not_found")
-        _, key_encrypted, status, tier, fail_streak = row
-        raw_key = decrypt_key(str(key_encrypted))
+@dataclass(frozen=True)
+class _CheckOutcome:
+    """Key updates computed by one subscription check, not yet written."""
+
+    key_id: int
+    status: str
+    tier: int | None
+    error: str | None
+    fail_streak: int
+    cooldown_until: float | None = None
+    result: str | None = None
+
+
+@dataclass(frozen=True)
+class _RuntimeCfg:
+    """Typed check settings, parsed once and passed to every check in a sweep."""
+
+    require_opus: bool
+    fail_threshold: int
+
+
+@lru_cache(maxsize=1)
+def _default_cfg() -> _RuntimeCfg:
+    return _RuntimeCfg(
+        require_opus=bool(settings.keypool_require_opus_tier),
+        fail_threshold=int(settings.keypool_health_check_fail_threshold or 3),
+    )
 
-        headers = {"Authorization": f"Bearer {raw_key}"}
-        try:
-            async with httpx.AsyncClient(timeout=15.0) as client:
-                resp = await client.get(SUBSCRIPTION_URL, headers=headers)
 
+@lru_cache(maxsize=8)
+def _parse_runtime_cfg(require_opus_raw: str, fail_threshold_raw: str | None) -> _RuntimeCfg:
+    # Keyed by the raw config strings: re-parsed only when the stored config changes.
+    require_opus = require_opus_raw.strip().lower() in ("1", "true", "yes", "on")
+    try:
+        fail_threshold = int(fail_threshold_raw or _default_cfg().fail_threshold)
+    except ValueError:
+        fail_threshold = _default_cfg().fail_threshold
+    return _RuntimeCfg(require_opus=require_opus, fail_threshold=fail_threshold)
+
+
+async def _evaluate_key(key_id: int, cfg: _RuntimeCfg) -> _CheckOutcome:
+    # Read + HTTP only; the caller decides when (and with what else) to commit.
+    db = await _get_conn()
+    async with db.execute(SELECT_KEY_FOR_CHECK_SQL, (int(key_id),)) as cur:
+        row = await cur.fetchone()
+    if not row:
+        raise KeyError("not_found")
+    _, key_encrypted, status, tier, fail_streak, cooldown_until = row
+    key_id = int(key_id)
+    raw_key = await asyncio.to_thread(decrypt_key, str(key_encrypted))
+
+    headers = {"Authorization": f"Bearer {raw_key}"}
+    try:
+        # Streamed so error responses are closed without reading their body;
+        # only a JSON success body is ever downloaded.
+        async with _get_http().stream("GET", SUBSCRIPTION_URL, headers=headers) as resp:
             code = int(resp.status_code)
-            msg = f"HTTP {code}"
-
-            # Follow your NovelAI error-code mapping.
-            if code in (401,):
-                fail_streak = int(fail_streak or 0) + 1
-                await _mark_status(db, int(key_id), "invalid", None, "Unauthorized", fail_streak)
-                await db.commit()
-                return {"id": int(key_id), "status": "checked", "result": "invalid"}
-
-            if code in (403,):
-                fail_streak = int(fail_streak or 0) + 1
-                await _mark_status(db, int(key_id), "invalid", tier, "Forbidden", fail_streak)
-                await db.commit()
-                return {"id": int(key_id), "status": "checked", "result": "invalid"}
-
-            if code == 402:
-                # Quota/subscription issue: treat as unhealthy and back off longer.
-                fail_streak = int(fail_streak or 0) + 1
-                await _set_cooldown(db, int(key_id), _compute_backoff(60, fail_streak, 3600))
-                new_status = "unhealthy" if fail_streak >= int(settings.keypool_health_check_fail_threshold or 3) else status
-                await _mark_status(db, int(key_id), new_status, tier, "Payment Required (402)", fail_streak)
-                await db.commit()
-                return {"id": int(key_id), "status": "checked", "result": "unhealthy"}
-
-            if code in (409, 429):
-                # Concurrency / rate limit: transient, do not immediately mark invalid.
-                fail_streak = min(int(fail_streak or 0) + 1, int(settings.keypool_health_check_fail_threshold or 3))
-                base = 3 if code == 409 else 8
-                cooldown = _compute_backoff(base, fail_streak, 300)
-                if code == 429:
-                    ra = _parse_retry_after(resp.headers)
-                    if ra is not None:
-                        cooldown = max(cooldown, ra)
-                await _set_cooldown(db, int(key_id), cooldown)
-                await _mark_status(db, int(key_id), status, tier, msg, fail_streak)
-                await db.commit()
-                return {"id": int(key_id), "status": "checked", "result": "transient"}
-
-            if code >= 500 or code in (502, 504):
-                # Upstream/server issue: transient. Mark unhealthy only after threshold.
-                fail_streak = int(fail_streak or 0) + 1
-                await _set_cooldown(db, int(key_id), _compute_backoff(15, fail_streak, 600))
-                new_status = "unhealthy" if fail_streak >= int(settings.keypool_health_check_fail_threshold or 3) else status
-                await _mark_status(db, int(key_id), new_status, tier, msg, fail_streak)
-                await db.commit()
-                return {"id": int(key_id), "status": "checked", "result": "transient"}
-
-            if code >= 400:
-                # Other 4xx: treat as unknown, degrade after threshold.
-                fail_streak = int(fail_streak or 0) + 1
-                new_status = "unhealthy" if fail_streak >= int(settings.keypool_health_check_fail_threshold or 3) else status
-                await _mark_status(db, int(key_id), new_status, tier, msg, fail_streak)
-                await db.commit()
-                return {"id": int(key_id), "status": "checked", "result": "unhealthy"}
-
-            # Success
-            data = resp.json() if resp.headers.get("content-type", "").startswith("application/json") else {}
-            tier_val = data.get("tier")
-            tier_val = int(tier_val) if isinstance(tier_val, int) or (isinstance(tier_val, str) and tier_val.isdigit()) else None
-            if settings.keypool_require_opus_tier and tier_val != 3:
-                await _mark_status(db, int(key_id), "unhealthy", tier_val, "Not Opus tier", 0)
-            else:
-                await _mark_status(db, int(key_id), "healthy", tier_val, None, 0)
-            await db.commit()
-        except Exception as exc:
+            if code < 400:
+                is_json = resp.headers.get("content-type", "").startswith("application/json")
+                body = await resp.aread() if is_json else b""
+        if code >= 400:
+            policy = _classify(code)
             fail_streak = int(fail_streak or 0) + 1
-            new_status = status
-            if fail_streak >= int(settings.keypool_health_check_fail_threshold or 3):
+            if policy.cap_streak:
+                fail_streak = min(fail_streak, cfg.fail_threshold)
+            cooldown = _compute_backoff(policy.backoff_base, fail_streak, policy.backoff_max)
+            if policy.honor_retry_after:
+                ra = _parse_retry_after(resp.headers)
+                if ra is not None:
+                    cooldown = max(cooldown, ra)
+            if policy.status is not None:
+                new_status = policy.status
+            elif policy.degrade and fail_streak >= cfg.fail_threshold:
                 new_status = "unhealthy"
-            await _mark_status(db, int(key_id), new_status, tier, f"Error: {exc}", fail_streak)
-            await _set_cooldown(db, int(key_id), _compute_backoff(10, fail_streak, 300))
-            await db.commit()
-    return {"id": int(key_id), "status": "checked"}
+            else:
+                new_status = status
+            return _CheckOutcome(
+                key_id,
+                new_status,
+                tier if policy.keep_tier else None,
+                policy.error or f"HTTP {code}",
+                fail_streak,
+                _extend_cooldown(cooldown_until, cooldown),
+                policy.result,
+            )
+
+        # Success
+        data = json.loads(body) if is_json else {}
+        tier_val = data.get("tier")
+        tier_val = int(tier_val) if isinstance(tier_val, int) or (isinstance(tier_val, str) and tier_val.isdigit()) else None
+        if cfg.require_opus and tier_val != 3:
+            return _CheckOutcome(key_id, "unhealthy", tier_val, "Not Opus tier", 0)
+        return _CheckOutcome(key_id, "healthy", tier_val, None, 0)
+    except Exception as exc:
+        fail_streak = int(fail_streak or 0) + 1
+        new_status = "unhealthy" if fail_streak >= cfg.fail_threshold else status
+        cooldown = _compute_backoff(10, fail_streak, 300)
+        return _CheckOutcome(key_id, new_status, tier, f"Error: {exc}", fail_streak, _extend_cooldown(cooldown_until, cooldown))
+
+
+async def _apply_outcome(db: aiosqlite.Connection, outcome: _CheckOutcome) -> None:
+    await _mark_status(db, outcome.key_id, outcome.status, outcome.tier, outcome.error, outcome.fail_streak)
+    await _set_cooldown(db, outcome.key_id, outcome.cooldown_until)
+
+
+def _outcome_response(outcome: _CheckOutcome) -> dict:
+    out = {"id": outcome.key_id, "status": "checked"}
+    if outcome.result is not None:
+        out["result"] = outcome.result
+    return out
+
+
+async def check_key_health(
+    key_id: int,
+    *,
+    require_opus: bool | None = None,
+    fail_threshold: int | None = None,
+) -> dict:
+    """
+    Check one key and persist the result.
+
+    Overrides are plain arguments (never written to the shared settings
+    object), so concurrent checks cannot see each other's values; None
+    falls back to settings.
+    """
+    _require_keypool_enabled()
+    cfg = _default_cfg()
+    if require_opus is not None or fail_threshold is not None:
+        cfg = _RuntimeCfg(
+            require_opus=cfg.require_opus if require_opus is None else bool(require_opus),
+            fail_threshold=cfg.fail_threshold if fail_threshold is None else int(fail_threshold),
+        )
+    # The HTTP call happens outside any transaction; only the write below
+    # takes the shared write lock.
+    outcome = await _evaluate_key(key_id, cfg)
+    async with _transaction() as db:
+        await _apply_outcome(db, outcome)
+    return _outcome_response(outcome)
 
 
 async def check_all_keys() -> int:
     _require_keypool_enabled()
 
     # Allow runtime overrides via DB config (front-end configurable).
-    cfg = await get_config(
+    values = await get_config(
         [
             "KEYPOOL_REQUIRE_OPUS_TIER",
             "KEYPOOL_HEALTH_CHECK_FAIL_THRESHOLD",
         ]
     )
-    require_opus = str(cfg.get("KEYPOOL_REQUIRE_OPUS_TIER", "")).strip().lower() in ("1", "true", "yes", "on")
-    try:
-        fail_threshold = int(cfg.get("KEYPOOL_HEALTH_CHECK_FAIL_THRESHOLD") or settings.keypool_health_check_fail_threshold or 3)
-    except Exception:
-        fail_threshold = int(settings.keypool_health_check_fail_threshold or 3)
-
-    async with aiosqlite.connect(_db_path()) as db:
-        async with db.execute("SELECT id FROM nai_keys WHERE is_enabled=1") as cur:
-            rows = await cur.fetchall()
-
-    count = 0
-    for (kid,) in rows:
-        try:
-            # Temporarily override these checks for this cycle.
-            old_req = settings.keypool_require_opus_tier
-            old_thr = settings.keypool_health_check_fail_threshold
-            settings.keypool_require_opus_tier = bool(require_opus)
-            settings.keypool_health_check_fail_threshold = int(fail_threshold)
-            await check_key_health(int(kid))
-        except Exception:
-            pass
-        finally:
-            settings.keypool_require_opus_tier = old_req
-            settings.keypool_health_check_fail_threshold = old_thr
-        count += 1
+    cfg = _parse_runtime_cfg(
+        str(values.get("KEYPOOL_REQUIRE_OPUS_TIER", "")),
+        values.get("KEYPOOL_HEALTH_CHECK_FAIL_THRESHOLD"),
+    )
+
+    db = await _get_conn()
+    async with db.execute(ENABLED_KEY_IDS_SQL) as cur:
+        rows = await cur.fetchall()
+    ids = [int(kid) for (kid,) in rows]
+
+    sem = asyncio.Semaphore(CHECK_CONCURRENCY)
+
+    async def _one(kid: int) -> _CheckOutcome:
+        async with sem:
+            return await _evaluate_key(kid, cfg)
+
+    # Check a batch concurrently, then write all of its results in one
+    # transaction: one WAL commit per batch instead of one per key.
+    for i in range(0, len(ids), CHECK_BATCH_SIZE):
+        # One bad key (e.g. deleted mid-sweep) must not abort the sweep.
+        results = await asyncio.gather(*(_one(kid) for kid in ids[i : i + CHECK_BATCH_SIZE]), return_exceptions=True)
+        outcomes = [r for r in results if isinstance(r, _CheckOutcome)]
+        if outcomes:
+            async with _transaction() as db:
+                for outcome in outcomes:
+                    await _apply_outcome(db, outcome)
 
     # Record aggregate snapshot for dashboard timeline.
     s = await summary()
@@ -331,7 +470,7 @@ async def check_all_keys() -> int:
         pending=int(statuses.get("pending") or 0),
     )
 
-    return count
+    return len(rows)
 
 
 async def checkout_best_key() -> dict:
@@ -341,48 +480,37 @@ async def checkout_best_key() -> dict:
     - order by total_checkouts ASC, last_checked_out_at ASC (NULLS FIRST)
     """
     _require_keypool_enabled()
-    async with aiosqlite.connect(_db_path()) as db:
-        await db.execute("BEGIN IMMEDIATE")
-        async with db.execute(
-            """
-            SELECT id, key_encrypted, key_hash, total_checkouts, last_checked_out_at
-            FROM nai_keys
-            WHERE is_enabled=1 AND status='healthy' AND (cooldown_until IS NULL OR cooldown_until <= ?)
-            ORDER BY total_checkouts ASC, COALESCE(last_checked_out_at, 0) ASC, id ASC
-            LIMIT 1
-            """,
-            (time.time(),),
-        ) as cur:
+    now = time.time()
+    async with _autocommit() as db:
+        async with db.execute(CHECKOUT_KEY_SQL, (now, now)) as cur:
             row = await cur.fetchone()
-        if not row:
-            await db.commit()
-            raise KeyError("no_healthy_key")
-        key_id, key_encrypted, key_hash, total_checkouts, last_checked_out_at = row
-        raw_key = decrypt_key(str(key_encrypted))
-        now = time.time()
-        await db.execute(
-            "UPDATE nai_keys SET total_checkouts=?, last_checked_out_at=? WHERE id=?",
-            (int(total_checkouts or 0) + 1, now, int(key_id)),
-        )
-        await db.commit()
+    if not row:
+        raise KeyError("no_healthy_key")
+    key_id, key_encrypted, key_hash = row
+    raw_key = await asyncio.to_thread(decrypt_key, str(key_encrypted))
     return {"id": int(key_id), "key": raw_key, "key_hash": str(key_hash)}
 
 
 async def summary() -> dict:
     _require_keypool_enabled()
-    async with aiosqlite.connect(_db_path()) as db:
-        async with db.execute("SELECT COUNT(*) FROM nai_keys") as cur:
-            total = await cur.fetchone()
-        async with db.execute("SELECT COUNT(*) FROM nai_keys WHERE is_enabled=1") as cur:
-            enabled = await cur.fetchone()
-        async with db.execute("SELECT status, COUNT(*) FROM nai_keys WHERE is_enabled=1 GROUP BY status") as cur:
-            by_status = await cur.fetchall()
-        async with db.execute("SELECT MAX(last_checked_at) FROM nai_keys WHERE is_enabled=1") as cur:
-            last_checked = await cur.fetchone()
-    status_map = {str(s): int(c or 0) for (s, c) in by_status}
+    db = await _get_conn()
+    async with db.execute(SUMMARY_SQL) as cur:
+        rows = await cur.fetchall()
+    total = 0
+    enabled = 0
+    status_map: dict[str, int] = {}
+    last_checked: float | None = None
+    for status, count, enabled_count, status_last_checked in rows:
+        total += int(count or 0)
+        enabled_count = int(enabled_count or 0)
+        if enabled_count:
+            enabled += enabled_count
+            status_map[str(status)] = enabled_count
+        if status_last_checked is not None and (last_checked is None or status_last_checked > last_checked):
+            last_checked = float(status_last_checked)
     return {
-        "total": int((total[0] if total else 0) or 0),
-        "enabled": int((enabled[0] if enabled else 0) or 0),
+        "total": total,
+        "enabled": enabled,
         "statuses": status_map,
-        "last_checked_at": (None if not last_checked or last_checked[0] is None else float(last_checked[0])),
+        "last_checked_at": last_checked,
     }
@@ -1,4 +1,6 @@
 import asyncio
+import random
+import time
 from datetime import datetime, timezone
 from pathlib import Path
 
@@ -8,8 +10,9 @@ from fastapi.staticfiles import StaticFiles
 from starlette.middleware.base import BaseHTTPMiddleware
 
 from app.auth import COOKIE_NAME, issue_session_cookie, require_login, verify_credentials, verify_session_cookie
-from app.config import settings
+from app.config import RUNTIME, settings
 from app.history_db import (
+    close_db,
     get_config,
     init_db,
     key_health_timeline,
@@ -19,6 +22,7 @@ from app.keypool import (
     check_all_keys,
     check_key_health,
     checkout_best_key,
+    close_http,
     delete_key,
     import_keys,
     list_keys,
@@ -27,6 +31,31 @@ from app.keypool import (
 )
 
 
+# Short-lived cache for endpoints the dashboard polls (key summary, config):
+# absorbs repeated polls between changes. Cleared by every write endpoint.
+_CACHE_TTL_SECONDS = 3.0
+_cache: dict[str, tuple[float, object]] = {}
+# Bumped by every invalidation; a load that overlapped one is not cached.
+_cache_generation = 0
+
+
+async def _cached(key: str, loader):
+    now = time.monotonic()
+    hit = _cache.get(key)
+    if hit is not None and hit[0] > now:
+        return hit[1]
+    generation = _cache_generation
+    value = await loader()
+    if generation == _cache_generation:
+        _cache[key] = (now + _CACHE_TTL_SECONDS, value)
+    return value
+
+
+def _invalidate_cache() -> None:
+    global _cache_generation
+    _cache_generation += 1
+    _cache.clear()
+
 
 def _require_status_token(authorization: str | None) -> None:
     token = (settings.status_token or "").strip()
@@ -91,7 +120,7 @@ async def readyz():
     detail = None
     if settings.keypool_enabled:
         try:
-            s = await keypool_summary()
+            s = await _cached("summary", keypool_summary)
             healthy = int((s.get("statuses") or {}).get("healthy") or 0)
             ok = healthy > 0
             if not ok:
@@ -117,7 +146,7 @@ async def statusz(request: Request, authorization: str | None = Header(default=N
     return {
         "time": datetime.now(timezone.utc).isoformat(),
         "keypool_enabled": bool(settings.keypool_enabled),
-        "keypool": (await keypool_summary()) if settings.keypool_enabled else None,
+        "keypool": (await _cached("summary", keypool_summary)) if settings.keypool_enabled else None,
     }
 
 
@@ -160,7 +189,7 @@ async def login(username: str = Form(...), password: str = Form(...)):
         httponly=True,
         samesite="lax",
         secure=bool(settings.auth_cookie_secure),
-        max_age=int(settings.auth_session_minutes or 1440) * 60,
+        max_age=RUNTIME.auth_session_seconds,
         path="/",
     )
     return resp
@@ -179,7 +208,7 @@ async def api_keys_summary(request: Request, authorization: str | None = Header(
     if not settings.keypool_enabled:
         raise HTTPException(status_code=400, detail="KEYPOOL_ENABLED=false")
     try:
-        return await keypool_summary()
+        return await _cached("summary", keypool_summary)
     except RuntimeError as exc:
         raise HTTPException(status_code=400, detail=str(exc))
     except Exception as exc:
@@ -195,7 +224,7 @@ async def api_get_config(request: Request, authorization: str | None = Header(de
         "KEYPOOL_HEALTH_CHECK_INTERVAL_SECONDS",
         "KEYPOOL_HEALTH_CHECK_FAIL_THRESHOLD",
     ]
-    values = await get_config(keys)
+    values = await _cached("config", lambda: get_config(keys))
     return {
         "keypool": {
             "require_opus_tier": values.get("KEYPOOL_REQUIRE_OPUS_TIER", str(settings.keypool_require_opus_tier)).lower()
@@ -230,6 +259,7 @@ async def api_set_config(
             "KEYPOOL_HEALTH_CHECK_FAIL_THRESHOLD": str(int(health_check_fail_threshold)),
         }
     )
+    _invalidate_cache()
     return {"saved": True}
 
 
@@ -245,26 +275,10 @@ async def api_list_keys(request: Request, authorization: str | None = Header(def
     except Exception as exc:
         raise HTTPException(status_code=500, detail=str(exc))
     now = datetime.now(timezone.utc).timestamp()
-    return {
-        "items": [
-            {
-                "id": k.id,
-                "key_hash": k.key_hash,
-                "status": k.status,
-                "tier": k.tier,
-                "is_enabled": k.is_enabled,
-                "fail_streak": k.fail_streak,
-                "cooldown_until": k.cooldown_until,
-                "cooldown_seconds": (None if not k.cooldown_until or k.cooldown_until <= now else int(k.cooldown_until - now)),
-                "last_checked_at": k.last_checked_at,
-                "last_error": k.last_error,
-                "total_checkouts": k.total_checkouts,
-                "last_checked_out_at": k.last_checked_out_at,
-                "created_at": k.created_at,
-            }
-            for k in items
-        ]
-    }
+    for k in items:
+        until = k["cooldown_until"]
+        k["cooldown_seconds"] = None if not until or until <= now else int(until - now)
+    return {"items": items}
 
 
 @app.post("/api/keys/import")
@@ -274,6 +288,7 @@ async def api_import_keys(request: Request, keys: str = Form(...), authorization
         raise HTTPException(status_code=400, detail="KEYPOOL_ENABLED=false")
     try:
         result = await import_keys(keys)
+        _invalidate_cache()
     except RuntimeError as exc:
         raise HTTPException(status_code=400, detail=str(exc))
     except Exception as exc:
@@ -293,6 +308,7 @@ async def api_toggle_key(
         raise HTTPException(status_code=400, detail="KEYPOOL_ENABLED=false")
     try:
         await set_enabled(int(key_id), bool(enabled))
+        _invalidate_cache()
     except Exception as exc:
         raise HTTPException(status_code=500, detail=str(exc))
     return {"id": int(key_id), "is_enabled": bool(enabled)}
@@ -305,6 +321,7 @@ async def api_delete_key(key_id: int, request: Request, authorization: str | Non
         raise HTTPException(status_code=400, detail="KEYPOOL_ENABLED=false")
     try:
         await delete_key(int(key_id))
+        _invalidate_cache()
     except Exception as exc:
         raise HTTPException(status_code=500, detail=str(exc))
     return {"id": int(key_id), "deleted": True}
@@ -317,6 +334,7 @@ async def api_check_key(key_id: int, request: Request, authorization: str | None
         raise HTTPException(status_code=400, detail="KEYPOOL_ENABLED=false")
     try:
         await check_key_health(int(key_id))
+        _invalidate_cache()
     except KeyError:
         raise HTTPException(status_code=404, detail="Key not found")
     except RuntimeError as exc:
@@ -333,6 +351,7 @@ async def api_check_all(request: Request, authorization: str | None = Header(def
         raise HTTPException(status_code=400, detail="KEYPOOL_ENABLED=false")
     try:
         total = await check_all_keys()
+        _invalidate_cache()
     except RuntimeError as exc:
         raise HTTPException(status_code=400, detail=str(exc))
     except Exception as exc:
@@ -372,28 +391,50 @@ async def status_page(request: Request):
 @app.on_event("startup")
 async def on_startup():
     await init_db()
-    loop = asyncio.get_event_loop()
 
     if settings.keypool_enabled and settings.keypool_health_check_enabled:
         async def _keypool_loop():
             while True:
+                # Config is read once per iteration into locals; fall back to settings on bad values.
+                enabled = bool(settings.keypool_health_check_enabled)
+                interval = int(settings.keypool_health_check_interval_seconds or 300)
+                start = time.monotonic()
                 try:
                     cfg = await get_config(["KEYPOOL_HEALTH_CHECK_ENABLED", "KEYPOOL_HEALTH_CHECK_INTERVAL_SECONDS"])
-                    enabled = cfg.get("KEYPOOL_HEALTH_CHECK_ENABLED")
-                    enabled = (
-                        str(enabled).lower() in ("1", "true", "yes", "on")
-                        if enabled is not None and enabled != ""
-                        else bool(settings.keypool_health_check_enabled)
-                    )
-                    interval = cfg.get("KEYPOOL_HEALTH_CHECK_INTERVAL_SECONDS") or settings.keypool_health_check_interval_seconds or 300
+                    value = cfg.get("KEYPOOL_HEALTH_CHECK_ENABLED")
+                    if value is not None and value != "":
+                        enabled = str(value).lower() in ("1", "true", "yes", "on")
+                    interval = int(cfg.get("KEYPOOL_HEALTH_CHECK_INTERVAL_SECONDS") or interval)
                     if enabled:
                         await check_all_keys()
+                        _invalidate_cache()
                 except Exception:
                     pass
-                try:
+                if enabled:
+                    # Sweeps start `interval` apart (the sweep's own duration is
+                    # subtracted, an overrunning sweep just waits the minimum), with
+                    # up to 10% jitter so restarts don't align with upstream load.
+                    elapsed = time.monotonic() - start
+                    delay = max(5.0, interval - elapsed + random.uniform(0, interval * 0.1))
+                else:
                     # When disabled, keep a short sleep so "enable" takes effect quickly.
-                    await asyncio.sleep(max(5, int(interval) if enabled else 5))
+                    delay = 5.0
+                try:
+                    await asyncio.sleep(delay)
                 except asyncio.CancelledError:
                     return
 
-        app.state._keypool_task = loop.create_task(_keypool_loop())
+        app.state._keypool_task = asyncio.create_task(_keypool_loop())
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    task = getattr(app.state, "_keypool_task", None)
+    if task is not None:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    await close_http()
+    await close_db()
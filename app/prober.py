@@ -1,15 +1,26 @@
 from __future__ import annotations
 
 import asyncio
+import codecs
+import contextlib
 import re
 import time
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import datetime, timezone
+from functools import lru_cache
+from time import perf_counter
+from typing import Awaitable, Callable
+from urllib.parse import urlsplit
 
 import httpx
 
 from app.config import settings
-from app.history_db import insert_events, prune_max_points_per_target, prune_old
+from app.history_db import events_writer_loop, flush_events, queue_events
+
+
+# Streams a response body through a target's content checks; returns the
+# failing check's error, or None when they all pass.
+BodyCheck = Callable[[httpx.Response], Awaitable["str | None"]]
 
 
 @dataclass(frozen=True)
@@ -19,9 +30,14 @@ class Target:
     expect: int = 200
     contains: str | None = None
     regex: str | None = None
+    # Content check specialized to this target's options by `_make_body_check`;
+    # None for status-only targets.
+    check_body: BodyCheck | None = field(default=None, compare=False, repr=False)
+    # URL host (netloc), used to bound per-host probe concurrency.
+    host: str = field(default="", compare=False, repr=False)
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class ProbeResult:
     name: str
     ok: bool
@@ -34,6 +50,189 @@ class ProbeResult:
     expect: int | None = None
 
 
+_REGEX_META = frozenset(".^$*+?{}[]\\|()")
+
+
+def _literal_prefix(pattern: str) -> str:
+    """Leading literal text every match of `pattern` must start with ("" if none)."""
+    if "|" in pattern:
+        # Alternation anywhere may bypass the prefix; don't try to reason about groups.
+        return ""
+    out: list[str] = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "\\":
+            # Only escaped punctuation is a literal; \d, \b, \1 ... are not.
+            if i + 1 >= len(pattern) or pattern[i + 1].isalnum():
+                break
+            c = pattern[i + 1]
+            step = 2
+        elif c in _REGEX_META:
+            break
+        else:
+            step = 1
+        # A char followed by ?, * or {m,n} may be absent from the match.
+        if pattern[i + step : i + step + 1] in ("?", "*", "{"):
+            break
+        out.append(c)
+        i += step
+    return "".join(out)
+
+
+def _body_limit() -> int:
+    return max(0, int(settings.probe_max_body_bytes or 0))
+
+
+def _limit_reached(body: bytes, limit: int) -> bool:
+    return bool(limit) and len(body) >= limit
+
+
+async def _read_body(resp: httpx.Response, limit: int) -> bytes:
+    # Stops at `limit` bytes; see `_limit_reached` for telling a cut-off body
+    # apart from one that simply lacks the marker.
+    buf = bytearray()
+    async for chunk in resp.aiter_bytes():
+        buf += chunk
+        if limit and len(buf) >= limit:
+            del buf[limit:]
+            break
+    return bytes(buf)
+
+
+_ASCII_BYTES = bytes(range(128))
+
+
+@lru_cache(maxsize=32)
+def _codec_name(encoding: str) -> str:
+    try:
+        return codecs.lookup(encoding).name
+    except LookupError:
+        return ""
+
+
+@lru_cache(maxsize=32)
+def _ascii_compatible(encoding: str) -> bool:
+    # True when ASCII bytes decode to the same ASCII text (not UTF-16/32 etc.).
+    try:
+        return _ASCII_BYTES.decode(encoding) == _ASCII_BYTES.decode("ascii")
+    except (LookupError, UnicodeDecodeError):
+        return False
+
+
+def _raw_search_ok(encoding: str, ascii_needle: bool) -> bool:
+    # A UTF-8 needle found in the raw bytes means exactly what finding it in
+    # the decoded text means only for UTF-8 bodies (or ASCII ones with an
+    # ASCII needle); other charsets go through the decoded text.
+    name = _codec_name(encoding)
+    return name == "utf-8" or (name == "ascii" and ascii_needle)
+
+
+def _decode(body: bytes, encoding: str) -> str:
+    return body.decode(encoding, errors="replace")
+
+
+def _body_contains(contains: str, body: bytes, encoding: str) -> bool:
+    if _raw_search_ok(encoding, contains.isascii()):
+        return contains.encode("utf-8") in body
+    return contains in _decode(body, encoding)
+
+
+def _make_body_check(contains: str | None, regex: str | None) -> BodyCheck | None:
+    """
+    Build the content check for one target with its constants baked in, so the
+    probe path runs exactly the checks configured and nothing else.
+
+    Matching is done on the raw body bytes only where that gives the same answer
+    as matching the decoded text (see `_raw_search_ok`, and ASCII bodies for
+    regexes); everything else is decoded with the response charset first.
+    """
+    needle = contains.encode("utf-8") if contains else b""
+    ascii_needle = bool(contains) and contains.isascii()
+
+    if not regex:
+        if not needle:
+            return None
+        keep = len(needle) - 1
+
+        async def check_contains(resp: httpx.Response) -> str | None:
+            limit = _body_limit()
+            encoding = resp.encoding or "utf-8"
+            if not _raw_search_ok(encoding, ascii_needle):
+                body = await _read_body(resp, limit)
+                if contains in _decode(body, encoding):
+                    return None
+                return "body_limit_reached" if _limit_reached(body, limit) else "missing_contains"
+            # Scan chunk by chunk (carrying len(needle)-1 bytes across
+            # boundaries) and stop at the first hit.
+            tail = b""
+            seen = 0
+            async for chunk in resp.aiter_bytes():
+                window = tail + chunk
+                if needle in window:
+                    return None
+                seen += len(chunk)
+                if limit and seen >= limit:
+                    return "body_limit_reached"
+                tail = window[-keep:] if keep else b""
+            return "missing_contains"
+
+        return check_contains
+
+    # A regex can match anywhere, so the body is buffered (up to the limit).
+    # The bytes pattern is only used on ASCII bodies, where `.`, `\w`, `\s` and
+    # negated classes see the same characters as the str pattern would.
+    try:
+        text_pattern: re.Pattern | None = re.compile(regex)
+    except re.error:
+        text_pattern = None
+    bytes_pattern: re.Pattern | None = None
+    prefix = b""
+    if text_pattern is not None and regex.isascii():
+        try:
+            bytes_pattern = re.compile(regex.encode("ascii"))
+        except re.error:
+            bytes_pattern = None
+        if bytes_pattern is not None and not bytes_pattern.flags & re.IGNORECASE:
+            # Literal every match starts with; located with bytes.find so the
+            # regex engine starts at the first candidate instead of offset 0.
+            prefix = _literal_prefix(regex).encode("ascii")
+
+    def search(body: bytes, encoding: str) -> str | None:
+        if contains and not _body_contains(contains, body, encoding):
+            return "missing_contains"
+        if bytes_pattern is not None and body.isascii() and _ascii_compatible(encoding):
+            start = 0
+            if prefix:
+                start = body.find(prefix)
+                if start < 0:
+                    return "missing_regex"
+            return None if bytes_pattern.search(body, start) else "missing_regex"
+        # An invalid pattern is compiled here so it raises on every probe,
+        # recording the error.
+        compiled = text_pattern or re.compile(regex)
+        return None if compiled.search(_decode(body, encoding)) else "missing_regex"
+
+    async def check_regex(resp: httpx.Response) -> str | None:
+        limit = _body_limit()
+        body = await _read_body(resp, limit)
+        error = search(body, resp.encoding or "utf-8")
+        if error is not None and _limit_reached(body, limit):
+            return "body_limit_reached"
+        return error
+
+    return check_regex
+
+
+def _url_host(url: str) -> str:
+    # A malformed URL (e.g. "http://[::1") must not fail the whole TARGETS
+    # list; its probe records the error instead.
+    try:
+        return urlsplit(url).netloc.lower()
+    except ValueError:
+        return ""
+
+
 def parse_targets(raw: str) -> list[Target]:
     raw = (raw or "").strip()
     if not raw:
@@ -50,115 +249,275 @@ def parse_targets(raw: str) -> list[Target]:
         regex: str | None = None
 
         for opt in parts[2:]:
-            if opt.startswith("expect="):
+            key, sep, value = opt.partition("=")
+            if not sep:
+                continue
+            if key == "expect":
                 try:
-                    expect = int(opt.split("=", 1)[1].strip())
-                except Exception:
+                    expect = int(value.strip())
+                except ValueError:
                     expect = 200
-            elif opt.startswith("contains="):
-                contains = opt.split("=", 1)[1]
-            elif opt.startswith("regex="):
-                regex = opt.split("=", 1)[1]
+            elif key == "contains":
+                contains = value
+            elif key == "regex":
+                regex = value
 
-        targets.append(Target(name=name or f"target-{idx}", url=url, expect=expect, contains=contains, regex=regex))
+        targets.append(
+            Target(
+                name=name or f"target-{idx}",
+                url=url,
+                expect=expect,
+                contains=contains,
+                regex=regex,
+                check_body=_make_body_check(contains, regex),
+                host=_url_host(url),
+            )
+        )
 
     return targets
 
 
+@lru_cache(maxsize=4)
+def _parse_targets_cached(raw: str) -> tuple[Target, ...]:
+    # Targets are frozen, so parsed results can be shared between callers.
+    return tuple(parse_targets(raw))
+
+
+# HEAD responses meaning "method not supported here"; retried as GET.
+_HEAD_UNSUPPORTED = frozenset({405, 501})
+
+
 class Prober:
     _targets_raw: str | None = None
     _targets: list[Target] = []
     _results: dict[str, ProbeResult] = {}
     _lock = asyncio.Lock()
+    # Kept across cycles so connections (TCP/TLS, DNS) are reused between probes.
+    _client: httpx.AsyncClient | None = None
+    _client_params: tuple[float, int] | None = None
+    # Built on first read after `_results` changes (see `_set_results`).
+    _snapshot_cache: list[dict] | None = None
+    # One byte per target (in `_targets` order): 1 if its latest probe was ok.
+    _ok_arr = bytearray()
 
     @classmethod
     def targets(cls) -> list[Target]:
         raw = settings.targets
         if cls._targets_raw == raw:
             return cls._targets
+        cls._targets = list(_parse_targets_cached(raw))
         cls._targets_raw = raw
-        cls._targets = parse_targets(raw)
-        cls._results = {t.name: cls._results.get(t.name) for t in cls._targets if t.name in cls._results}
+        cls._set_results({t.name: cls._results.get(t.name) for t in cls._targets if t.name in cls._results})
         return cls._targets
 
+    @classmethod
+    def _set_results(cls, results: dict[str, ProbeResult]) -> None:
+        cls._results = results
+        cls._snapshot_cache = None
+        cls._ok_arr = bytearray(1 if (r := results.get(t.name)) is not None and r.ok else 0 for t in cls._targets)
+
     @staticmethod
-    def _utc_now_iso() -> str:
-        return datetime.now(timezone.utc).isoformat()
+    async def _fetch_status(client: httpx.AsyncClient, url: str) -> int:
+        # Status-only: HEAD transfers no body at all. Servers that reject HEAD
+        # get a streamed GET whose body is never read.
+        async with client.stream("HEAD", url) as resp:
+            status_code = resp.status_code
+        if status_code in _HEAD_UNSUPPORTED:
+            async with client.stream("GET", url) as resp:
+                status_code = resp.status_code
+        return status_code
+
+    @staticmethod
+    def _result(
+        target: Target,
+        ok: bool,
+        status_code: int | None,
+        latency_ms: float,
+        error: str | None,
+        checked_at: str,
+    ) -> ProbeResult:
+        return ProbeResult(
+            name=target.name,
+            ok=ok,
+            status_code=status_code,
+            latency_ms=latency_ms,
+            error=error,
+            checked_at=checked_at,
+            url=target.url if settings.expose_urls else None,
+            expect=target.expect,
+        )
 
     @classmethod
-    async def probe_one(cls, client: httpx.AsyncClient, target: Target) -> ProbeResult:
-        start = time.perf_counter()
+    async def probe_one(cls, client: httpx.AsyncClient, target: Target, checked_at: str) -> ProbeResult:
+        start = perf_counter()
+        url = target.url
+        expect = target.expect
         status_code: int | None = None
         error: str | None = None
         ok = False
+        check_body = target.check_body
         try:
-            resp = await client.get(target.url)
-            status_code = resp.status_code
-            if status_code != target.expect:
-                ok = False
-                error = f"unexpected_status:{status_code}"
+            if check_body is None:
+                status_code = await cls._fetch_status(client, url)
+                ok = status_code == expect
+                if not ok:
+                    error = f"unexpected_status:{status_code}"
             else:
-                ok = True
-            if ok and (target.contains or target.regex):
-                body = resp.text
-                if target.contains and target.contains not in body:
-                    ok = False
-                    error = "missing_contains"
-                if ok and target.regex:
-                    if not re.search(target.regex, body):
+                # Streamed: the body is only read as far as the content check needs.
+                async with client.stream("GET", url) as resp:
+                    status_code = resp.status_code
+                    if status_code != expect:
                         ok = False
-                        error = "missing_regex"
+                        error = f"unexpected_status:{status_code}"
+                    else:
+                        error = await check_body(resp)
+                        ok = error is None
         except Exception as exc:
             ok = False
             error = str(exc)
-        latency_ms = (time.perf_counter() - start) * 1000.0
-        return ProbeResult(
-            name=target.name,
-            ok=ok,
-            status_code=status_code,
-            latency_ms=latency_ms,
-            error=error,
-            checked_at=cls._utc_now_iso(),
-            url=target.url if settings.expose_urls else None,
-            expect=target.expect,
+        return cls._result(target, ok, status_code, (perf_counter() - start) * 1000.0, error, checked_at)
+
+    @classmethod
+    async def probe_shared(cls, client: httpx.AsyncClient, group: list[Target], checked_at: str) -> list[ProbeResult]:
+        """Probe targets that share one URL with a single request; each keeps its own expect/checks."""
+        start = perf_counter()
+        url = group[0].url
+        status_code: int | None = None
+        shared: httpx.Response | None = None
+        fetch_error: str | None = None
+        try:
+            if all(t.check_body is None for t in group):
+                status_code = await cls._fetch_status(client, url)
+            else:
+                async with client.stream("GET", url) as resp:
+                    status_code = resp.status_code
+                    if any(t.check_body is not None and t.expect == status_code for t in group):
+                        # Buffered once (up to the body limit) and replayed to each
+                        # target's check. Only content-type is carried over: the
+                        # body is already decoded, and it selects the text encoding.
+                        body = await _read_body(resp, _body_limit())
+                        headers = {"content-type": resp.headers.get("content-type", "")}
+                        shared = httpx.Response(status_code, headers=headers, content=body)
+        except Exception as exc:
+            fetch_error = str(exc)
+        latency_ms = (perf_counter() - start) * 1000.0
+
+        # contains-only targets are answered with one search per distinct marker
+        # over the shared body, however many targets repeat it.
+        body = shared.content if shared is not None else b""
+        encoding = (shared.encoding if shared is not None else None) or "utf-8"
+        marker_hits: dict[str, bool] = {}
+
+        out: list[ProbeResult] = []
+        for t in group:
+            error: str | None = None
+            if fetch_error is not None:
+                error = fetch_error
+            elif status_code != t.expect:
+                error = f"unexpected_status:{status_code}"
+            elif t.contains and not t.regex:
+                hit = marker_hits.get(t.contains)
+                if hit is None:
+                    hit = marker_hits[t.contains] = _body_contains(t.contains, body, encoding)
+                if not hit:
+                    error = "body_limit_reached" if _limit_reached(body, _body_limit()) else "missing_contains"
+            elif t.check_body is not None:
+                try:
+                    error = await t.check_body(shared)
+                except Exception as exc:
+                    error = str(exc)
+            out.append(cls._result(t, error is None, status_code, latency_ms, error, checked_at))
+        return out
+
+    @classmethod
+    async def _get_client(cls) -> httpx.AsyncClient:
+        timeout = float(settings.probe_timeout_seconds or 5.0)
+        concurrency = max(1, int(settings.probe_concurrency or 20))
+        params = (timeout, concurrency)
+        if cls._client is not None and cls._client_params == params:
+            return cls._client
+        if cls._client is not None:
+            await cls._client.aclose()
+        cls._client = httpx.AsyncClient(
+            timeout=httpx.Timeout(timeout),
+            # Keep every pooled connection alive between cycles; with HTTP/2,
+            # probes to the same host share one connection as multiplexed streams.
+            limits=httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency),
+            follow_redirects=True,
+            http2=True,
         )
+        cls._client_params = params
+        return cls._client
+
+    @staticmethod
+    async def flush() -> None:
+        """Write any queued history rows now (used on shutdown)."""
+        await flush_events()
+
+    @classmethod
+    async def shutdown(cls) -> None:
+        if cls._client is not None:
+            await cls._client.aclose()
+            cls._client = None
+            cls._client_params = None
 
     @classmethod
     async def probe_all_once(cls) -> list[ProbeResult]:
         targets = cls.targets()
         if not targets:
             async with cls._lock:
-                cls._results = {}
+                cls._set_results({})
             return []
 
-        timeout = httpx.Timeout(float(settings.probe_timeout_seconds or 5.0))
-        limits = httpx.Limits(max_connections=max(1, int(settings.probe_concurrency or 20)))
+        client = await cls._get_client()
         sem = asyncio.Semaphore(max(1, int(settings.probe_concurrency or 20)))
+        # Per-host slots are taken before global ones, so probes queued behind a
+        # stalled host never hold global slots that other hosts could use.
+        per_host = max(1, int(settings.probe_concurrency_per_host or 4))
+        host_sems = {t.host: asyncio.Semaphore(per_host) for t in targets}
 
-        async with httpx.AsyncClient(timeout=timeout, limits=limits, follow_redirects=True) as client:
-            async def run_one(t: Target) -> ProbeResult:
-                async with sem:
-                    return await cls.probe_one(client, t)
+        # One timestamp for the whole cycle (also the history `ts`, which the
+        # timeline groups by); latency stays per probe.
+        now = time.time()
+        checked_at = datetime.fromtimestamp(now, timezone.utc).isoformat()
 
-            results = await asyncio.gather(*(run_one(t) for t in targets), return_exceptions=False)
+        # Targets sharing a URL are fetched once per cycle.
+        by_url: dict[str, list[Target]] = {}
+        for t in targets:
+            by_url.setdefault(t.url, []).append(t)
 
-        async with cls._lock:
-            cls._results = {r.name: r for r in results}
+        async def run_group(group: list[Target]) -> list[ProbeResult]:
+            async with host_sems[group[0].host], sem:
+                if len(group) == 1:
+                    return [await cls.probe_one(client, group[0], checked_at)]
+                return await cls.probe_shared(client, group, checked_at)
 
-        # Persist history to SQLite (batch).
-        now = time.time()
-        rows = [
-            (r.name, now, 1 if r.ok else 0, r.status_code, r.latency_ms)
-            for r in results
-        ]
-        await insert_events(rows)
-        await prune_old(int(settings.history_retention_minutes or 0))
-        await prune_max_points_per_target(int(settings.history_max_points_per_target or 0))
+        # Each result is queued for history as soon as it lands rather than
+        # after the slowest probe; the writer task picks it up in the background.
+        results: list[ProbeResult] = []
+        tasks = [asyncio.create_task(run_group(g)) for g in by_url.values()]
+        try:
+            for fut in asyncio.as_completed(tasks):
+                done = await fut
+                results.extend(done)
+                queue_events([(r.name, now, 1 if r.ok else 0, r.status_code, r.latency_ms) for r in done])
+        finally:
+            # On cancellation or error, stop the remaining probes before the
+            # caller closes the shared client.
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        async with cls._lock:
+            cls._set_results({r.name: r for r in results})
         return results
 
     @classmethod
     def snapshot(cls) -> list[dict]:
+        # Cached until the next probe cycle; callers must treat it as read-only.
         targets = cls.targets()
+        if cls._snapshot_cache is not None:
+            return cls._snapshot_cache
         out: list[dict] = []
         for t in targets:
             r = cls._results.get(t.name)
@@ -174,27 +533,37 @@ class Prober:
                     "expect": t.expect,
                 }
             )
+        cls._snapshot_cache = out
         return out
 
     @classmethod
     def overall_ok(cls) -> bool:
-        items = cls.snapshot()
-        if not items:
+        if not cls.targets():
             return True
+        # any()/all() over the bytearray run as C loops; a target without a
+        # result yet counts as not ok.
+        oks = cls._ok_arr
         strategy = (settings.ready_strategy or "all").strip().lower()
-        oks = [bool(i.get("ok")) for i in items]
-        if strategy == "any":
-            return any(oks)
-        return all(oks)
+        return any(oks) if strategy == "any" else all(oks)
 
 
 async def probe_loop() -> None:
-    while True:
-        try:
-            await Prober.probe_all_once()
-        except Exception:
-            pass
-        try:
-            await asyncio.sleep(max(1, int(settings.probe_interval_seconds or 30)))
-        except asyncio.CancelledError:
-            return
+    writer = asyncio.create_task(events_writer_loop())
+    try:
+        while True:
+            try:
+                await Prober.probe_all_once()
+            except Exception:
+                pass
+            try:
+                await asyncio.sleep(max(1, int(settings.probe_interval_seconds or 30)))
+            except asyncio.CancelledError:
+                return
+    finally:
+        writer.cancel()
+        # Let an in-flight flush finish before the final one, so both never
+        # write the same rows.
+        with contextlib.suppress(asyncio.CancelledError):
+            await writer
+        await Prober.flush()
+        await Prober.shutdown()